@@ -1,26 +1,64 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Header
 from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, ReturnDocument, monitoring
+from pymongo.errors import DuplicateKeyError
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 import uuid
+import hashlib
+import hmac
+import random
+from contextvars import ContextVar
 from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 import httpx
+from pyinstrument import Profiler
+from pyinstrument.renderers import SpeedscopeRenderer
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Mongo operations issued by the current request (see enforce_mongo_op_budget)
+request_mongo_ops: ContextVar[Optional[list]] = ContextVar("request_mongo_ops", default=None)
+# Mongo command timings, only collected while the request is being profiled
+request_mongo_timings: ContextVar[Optional[list]] = ContextVar("request_mongo_timings", default=None)
+
+class MongoOpCounter(monitoring.CommandListener):
+    """Record every command sent to Mongo on behalf of the current request"""
+    # Cursor continuations and session cleanup are not separate logical operations
+    IGNORED_COMMANDS = {"getMore", "killCursors", "endSessions"}
+    
+    def started(self, event):
+        ops = request_mongo_ops.get()
+        if ops is not None and event.command_name not in self.IGNORED_COMMANDS:
+            ops.append(event.command_name)
+    
+    def succeeded(self, event):
+        timings = request_mongo_timings.get()
+        if timings is not None:
+            timings.append({"command": event.command_name, "duration_ms": event.duration_micros / 1000})
+    
+    def failed(self, event):
+        timings = request_mongo_timings.get()
+        if timings is not None:
+            timings.append({"command": event.command_name, "duration_ms": event.duration_micros / 1000, "failed": True})
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoOpCounter()])
 db = client[os.environ['DB_NAME']]
 
 # Security
@@ -32,6 +70,41 @@ JWT_EXPIRATION_DAYS = 7
 # Stripe
 STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY')
 
+# Archival of historical bookings
+ARCHIVE_HORIZON_DAYS = int(os.environ.get('ARCHIVE_HORIZON_DAYS', '90'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '500'))
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get('ARCHIVE_INTERVAL_HOURS', '24'))
+
+# Occupancy analytics
+ANALYTICS_INTERVAL_HOURS = float(os.environ.get('ANALYTICS_INTERVAL_HOURS', '24'))
+ANALYTICS_DOC_ID = "occupancy_heatmap"
+
+# Court search
+COURT_TIMEZONE = ZoneInfo(os.environ.get('COURT_TIMEZONE', 'Asia/Dubai'))
+SEARCH_MAX_DAYS = 14
+SEARCH_MAX_RESULTS = 50
+
+# Per-request Mongo operation budgets
+# Debug mode exposes each response's count in an X-Mongo-Ops header (used by the tests)
+MONGO_OP_BUDGET_DEBUG = os.environ.get('MONGO_OP_BUDGET_DEBUG', 'false').lower() == 'true'
+
+# Request profiling
+# The header's value must match PROFILE_SECRET; without a configured secret the header is ignored
+PROFILE_HEADER = "X-Profile-Request"
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET')
+PROFILE_INTERVAL_SECONDS = 0.001
+PROFILE_TTL_DAYS = 7
+
+# Idempotency keys
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+IDEMPOTENCY_CACHE_SIZE = 10000
+IDEMPOTENCY_WAIT_SECONDS = 30
+IDEMPOTENCY_LEASE_SECONDS = 30  # A crashed or cancelled request's key can be taken over after this
+# Waiting on another worker backs off from 0.1s to 2s between polls, which covers IDEMPOTENCY_WAIT_SECONDS in 20
+IDEMPOTENCY_POLL_INITIAL_SECONDS = 0.1
+IDEMPOTENCY_POLL_MAX_SECONDS = 2
+IDEMPOTENCY_MAX_POLLS = 20
+
 # Create the main app
 app = FastAPI()
 
@@ -88,6 +161,10 @@ class CourtCreate(BaseModel):
     description_en: str
     image_url: Optional[str] = None
 
+class CourtStatusUpdate(BaseModel):
+    court_ids: List[str]
+    is_active: bool
+
 class Booking(BaseModel):
     model_config = ConfigDict(extra="ignore")
     booking_id: str
@@ -106,6 +183,11 @@ class BookingCreate(BaseModel):
     date: str
     time_slot: str
 
+class BulkCancelRequest(BaseModel):
+    court_id: str
+    date_from: str  # YYYY-MM-DD, inclusive
+    date_to: str  # YYYY-MM-DD, inclusive
+
 class Review(BaseModel):
     model_config = ConfigDict(extra="ignore")
     review_id: str
@@ -137,6 +219,126 @@ class CheckoutRequest(BaseModel):
     booking_id: str
     origin_url: str
 
+class ProfilingConfig(BaseModel):
+    sample_rate: float = 0.0  # 0 disables sampling
+    path: Optional[str] = None  # Route path to sample, e.g. /api/bookings/{booking_id}; None samples every route
+
+# ==================== DATA ACCESS ====================
+
+# Worst-case Mongo operations per route, including authentication. Requests
+# exceeding their budget are logged, and tests/test_mongo_op_budgets.py asserts
+# every route against this table. None means unbounded.
+MONGO_OP_BUDGETS: Dict[tuple, Optional[int]] = {
+    ("POST", "/api/auth/register"): 1,
+    ("POST", "/api/auth/login"): 1,
+    ("POST", "/api/auth/google/callback"): 2,
+    ("GET", "/api/auth/me"): 1,
+    ("POST", "/api/auth/logout"): 1,
+    ("GET", "/api/courts"): 1,
+    ("GET", "/api/courts/search"): 1,
+    ("GET", "/api/courts/{court_id}"): 1,
+    ("POST", "/api/courts"): 2,
+    ("GET", "/api/bookings/availability"): 2,
+    # Bookings 4 and checkout 3, plus reserving, taking over and completing an Idempotency-Key,
+    # plus up to IDEMPOTENCY_MAX_POLLS polls while another worker holds the key and two to reclaim it
+    # if that worker gives up. A handler slower than IDEMPOTENCY_LEASE_SECONDS / 3 adds one lease
+    # renewal per interval, and a key handed over more than once can overrun; both are logged.
+    ("POST", "/api/bookings"): 7 + IDEMPOTENCY_MAX_POLLS + 2,
+    ("GET", "/api/bookings/my"): 2,
+    ("GET", "/api/bookings/{booking_id}"): 3,  # 2, plus the archive fallback
+    ("PATCH", "/api/bookings/{booking_id}/cancel"): 3,
+    ("POST", "/api/payments/checkout"): 6 + IDEMPOTENCY_MAX_POLLS + 2,  # See POST /api/bookings
+    ("GET", "/api/payments/status/{session_id}"): 4,
+    ("POST", "/api/webhook/stripe"): 2,
+    ("POST", "/api/reviews"): 4,  # 3, plus the archive fallback
+    ("GET", "/api/reviews/{court_id}"): 1,
+    ("GET", "/api/admin/bookings"): 2,
+    ("GET", "/api/admin/users"): 2,
+    ("GET", "/api/admin/stats"): 5,
+    ("POST", "/api/admin/courts/bulk"): 2,
+    ("PATCH", "/api/admin/courts/status"): 3,
+    ("POST", "/api/admin/bookings/cancel"): 3,
+    ("POST", "/api/admin/archive"): None,  # Batched, proportional to archived bookings
+    ("GET", "/api/admin/analytics"): 2,
+    ("POST", "/api/admin/analytics/refresh"): None,  # Proportional to the days being aggregated
+    ("GET", "/api/admin/profiling"): 1,
+    ("PUT", "/api/admin/profiling"): 1,
+    ("GET", "/api/admin/profiles"): 2,
+    ("GET", "/api/admin/profiles/{profile_id}"): 2,
+}
+
+async def find_session_with_user(session_token: str) -> Optional[dict]:
+    """Fetch a session together with its user in a single round trip"""
+    sessions = await db.user_sessions.aggregate([
+        {"$match": {"session_token": session_token}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": "users",
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "as": "user"
+        }},
+        {"$project": {"_id": 0, "user._id": 0, "user.password_hash": 0}}
+    ]).to_list(1)
+    if not sessions:
+        return None
+    
+    session = sessions[0]
+    session["user"] = session["user"][0] if session["user"] else None
+    return session
+
+async def upsert_google_user(google_user: dict) -> dict:
+    """Create or refresh a Google user and return the stored document"""
+    return await db.users.find_one_and_update(
+        {"email": google_user["email"]},
+        {
+            "$set": {
+                "name": google_user["name"],
+                "picture": google_user["picture"]
+            },
+            "$setOnInsert": {
+                "user_id": f"user_{uuid.uuid4().hex[:12]}",
+                "phone": "",  # Can be updated later
+                "language": "ar",
+                "role": "user",
+                "created_at": datetime.now(timezone.utc)
+            }
+        },
+        projection={"_id": 0, "password_hash": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+async def find_taken_slots(court_id: str, date: str) -> set:
+    """All booked time slots for a court on a date"""
+    bookings = await db.bookings.find(
+        {"court_id": court_id, "date": date, "status": {"$ne": "cancelled"}},
+        {"_id": 0, "time_slot": 1}
+    ).to_list(None)
+    return {booking["time_slot"] for booking in bookings}
+
+async def mark_transaction_paid(session_id: str) -> Optional[dict]:
+    """Mark a transaction and its booking as paid; returns the transaction, or None if unknown"""
+    transaction = await db.payment_transactions.find_one_and_update(
+        {"session_id": session_id},
+        {"$set": {
+            "payment_status": "paid",
+            "updated_at": datetime.now(timezone.utc)
+        }},
+        projection={"_id": 0, "booking_id": 1}
+    )
+    # Not conditional on the transaction's previous state: if an earlier attempt marked the
+    # transaction but failed before the booking, a webhook retry or status poll repairs it
+    if transaction:
+        await db.bookings.update_one(
+            {"booking_id": transaction["booking_id"]},
+            {"$set": {
+                "payment_status": "paid",
+                "status": "confirmed"
+            }}
+        )
+    return transaction
+
 # ==================== HELPER FUNCTIONS ====================
 
 def hash_password(password: str) -> str:
@@ -167,32 +369,34 @@ async def get_current_user(request: Request) -> User:
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    # Check if it's a session_token (from Google OAuth)
-    session = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
-    if session:
-        expires_at = session["expires_at"]
-        if isinstance(expires_at, str):
-            expires_at = datetime.fromisoformat(expires_at)
-        if expires_at.tzinfo is None:
-            expires_at = expires_at.replace(tzinfo=timezone.utc)
-        if expires_at < datetime.now(timezone.utc):
-            raise HTTPException(status_code=401, detail="Session expired")
-        
-        user_doc = await db.users.find_one({"user_id": session["user_id"]}, {"_id": 0})
-        if not user_doc:
-            raise HTTPException(status_code=404, detail="User not found")
-        return User(**user_doc)
-    
-    # Try JWT token
+    # Try JWT token first: decoding is local, so only the user lookup hits Mongo
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("user_id")
-        user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+    except JWTError:
+        payload = None
+    
+    if payload:
+        user_doc = await db.users.find_one({"user_id": payload.get("user_id")}, {"_id": 0})
         if not user_doc:
             raise HTTPException(status_code=404, detail="User not found")
         return User(**user_doc)
-    except JWTError:
+    
+    # Otherwise it must be a session_token (from Google OAuth)
+    session = await find_session_with_user(token)
+    if not session:
         raise HTTPException(status_code=401, detail="Invalid token")
+    
+    expires_at = session["expires_at"]
+    if isinstance(expires_at, str):
+        expires_at = datetime.fromisoformat(expires_at)
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    if expires_at < datetime.now(timezone.utc):
+        raise HTTPException(status_code=401, detail="Session expired")
+    
+    if not session["user"]:
+        raise HTTPException(status_code=404, detail="User not found")
+    return User(**session["user"])
 
 def calculate_price(time_slot: str) -> float:
     """Calculate price based on time slot (morning: 100 AED, evening: 135 AED)"""
@@ -212,16 +416,354 @@ async def check_slot_availability(court_id: str, date: str, time_slot: str) -> b
     })
     return existing_booking is None
 
+def generate_time_slots() -> List[str]:
+    """All bookable 60-min slots (8 AM to 11 PM, last slot starts at 11 PM)"""
+    return [f"{hour:02d}:00" for hour in range(8, 24)]
+
+# In-memory front of the idempotency_keys collection: completed responses and in-flight requests
+idempotency_cache: Dict[str, tuple] = {}
+idempotency_inflight: Dict[str, tuple] = {}
+# Pending key releases, referenced until done so they are not garbage-collected mid-flight
+idempotency_release_tasks: set = set()
+
+async def claim_idempotency_key(cache_key: str, fingerprint: str) -> bool:
+    """Reserve a key for this request, or take over one whose holder's lease has expired"""
+    now = datetime.now(timezone.utc)
+    locked_until = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+    try:
+        await db.idempotency_keys.insert_one({
+            "key": cache_key,
+            "fingerprint": fingerprint,
+            "status": "in_progress",
+            "locked_until": locked_until,
+            "created_at": now
+        })
+        return True
+    except DuplicateKeyError:
+        pass
+    
+    record = await db.idempotency_keys.find_one_and_update(
+        {
+            "key": cache_key,
+            "fingerprint": fingerprint,
+            "status": "in_progress",
+            "$or": [{"locked_until": {"$lt": now}}, {"locked_until": {"$exists": False}}]
+        },
+        {"$set": {"locked_until": locked_until}}
+    )
+    return record is not None
+
+def release_idempotency_key(cache_key: str):
+    """Drop an unfinished reservation so a retry can run the request again"""
+    # Scheduled rather than awaited so it still runs while the request itself is being cancelled
+    task = asyncio.ensure_future(db.idempotency_keys.delete_one({"key": cache_key, "status": "in_progress"}))
+    idempotency_release_tasks.add(task)
+    task.add_done_callback(idempotency_release_tasks.discard)
+
+async def renew_idempotency_lease(cache_key: str):
+    """Keep extending the lease while the handler runs, so a slow provider call is never taken over"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_LEASE_SECONDS / 3)
+        try:
+            await db.idempotency_keys.update_one(
+                {"key": cache_key, "status": "in_progress"},
+                {"$set": {"locked_until": datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}}
+            )
+        except Exception:
+            logger.exception(f"Failed to renew lease for idempotency key {cache_key}")
+
+async def wait_for_idempotent_response(cache_key: str, fingerprint: str, deadline: float, polls_left: int) -> Tuple[Optional[dict], int]:
+    """Wait for a request with the same key, held by another worker, to finish
+
+    Polls with exponential backoff, spending at most polls_left polls, and returns the response with the
+    polls still left. The response is None when the key was released or its lease expired, so the caller
+    can claim it.
+    """
+    loop = asyncio.get_running_loop()
+    delay = IDEMPOTENCY_POLL_INITIAL_SECONDS
+    while polls_left > 0 and loop.time() < deadline:
+        await asyncio.sleep(min(delay, max(deadline - loop.time(), 0)))
+        delay = min(delay * 2, IDEMPOTENCY_POLL_MAX_SECONDS)
+        polls_left -= 1
+        record = await db.idempotency_keys.find_one({"key": cache_key}, {"_id": 0})
+        if not record:
+            return None, polls_left
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request")
+        if record["status"] == "completed":
+            return record["response"], polls_left
+        locked_until = record.get("locked_until")
+        if locked_until is None or locked_until.replace(tzinfo=timezone.utc) < datetime.now(timezone.utc):
+            return None, polls_left
+    raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is still in progress")
+
+async def run_idempotent(idempotency_key: Optional[str], scope: str, user_id: str, payload: BaseModel, handler) -> dict:
+    """Run handler once per Idempotency-Key; replays and concurrent duplicates get the stored response"""
+    if not idempotency_key:
+        return await handler()
+    
+    cache_key = f"{scope}:{user_id}:{idempotency_key}"
+    fingerprint = hashlib.sha256(payload.model_dump_json().encode()).hexdigest()
+    
+    cached = idempotency_cache.get(cache_key)
+    if cached and cached[0] > datetime.now(timezone.utc):
+        if cached[1] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request")
+        return cached[2]
+    
+    inflight = idempotency_inflight.get(cache_key)
+    if inflight:
+        if inflight[0] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request")
+        try:
+            return await asyncio.wait_for(asyncio.shield(inflight[1]), IDEMPOTENCY_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is still in progress")
+    
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    idempotency_inflight[cache_key] = (fingerprint, future)
+    deadline = loop.time() + IDEMPOTENCY_WAIT_SECONDS
+    polls_left = IDEMPOTENCY_MAX_POLLS
+    try:
+        response = None
+        while response is None:
+            if not await claim_idempotency_key(cache_key, fingerprint):
+                response, polls_left = await wait_for_idempotent_response(cache_key, fingerprint, deadline, polls_left)
+                continue
+            
+            heartbeat = asyncio.ensure_future(renew_idempotency_lease(cache_key))
+            try:
+                # Stored and replayed in JSON form, so every replay matches the original byte for byte
+                response = jsonable_encoder(await handler())
+            except BaseException:
+                release_idempotency_key(cache_key)
+                raise
+            finally:
+                heartbeat.cancel()
+            
+            try:
+                await db.idempotency_keys.update_one(
+                    {"key": cache_key},
+                    {"$set": {"status": "completed", "response": response}, "$unset": {"locked_until": ""}}
+                )
+            except Exception:
+                # The response is still served and cached here; other workers take over once the lease expires
+                logger.exception(f"Failed to store response for idempotency key {cache_key}")
+        
+        if len(idempotency_cache) >= IDEMPOTENCY_CACHE_SIZE:
+            idempotency_cache.pop(next(iter(idempotency_cache)))
+        expires_at = datetime.now(timezone.utc) + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+        idempotency_cache[cache_key] = (expires_at, fingerprint, response)
+        future.set_result(response)
+        return response
+    except BaseException as e:
+        # Cancellation must not propagate into waiting duplicates, which would hang or be cancelled with it
+        if not isinstance(e, Exception):
+            e = HTTPException(status_code=409, detail="Original request was interrupted, retry")
+        future.set_exception(e)
+        future.exception()  # Mark as retrieved when nobody else is waiting
+        raise
+    finally:
+        idempotency_inflight.pop(cache_key, None)
+
+async def find_booking(query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+    """Find a booking in the hot collection, falling back to the archive"""
+    booking = await db.bookings.find_one(query, projection)
+    if booking is None:
+        booking = await db.bookings_archive.find_one(query, projection)
+    return booking
+
+async def find_bookings_with_archive(query: dict, limit: int) -> List[dict]:
+    """Newest bookings matching a query across the hot collection and the archive, in one round trip"""
+    return await db.bookings.aggregate([
+        {"$match": query},
+        {"$unionWith": {"coll": "bookings_archive", "pipeline": [{"$match": query}]}},
+        {"$sort": {"created_at": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0}}
+    ]).to_list(limit)
+
+async def archive_old_bookings(horizon_days: int = ARCHIVE_HORIZON_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE) -> Dict[str, int]:
+    """Move bookings older than the horizon, and their payment transactions, into the archive collections"""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=horizon_days)).strftime("%Y-%m-%d")
+    archived_bookings = 0
+    archived_transactions = 0
+    
+    while True:
+        batch = await db.bookings.find({"date": {"$lt": cutoff}}).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        booking_ids = [booking["booking_id"] for booking in batch]
+        
+        # Copy first, delete second: re-running after a crash only rewrites the same archive docs
+        transactions = await db.payment_transactions.find(
+            {"booking_id": {"$in": booking_ids}}
+        ).to_list(None)
+        if transactions:
+            await db.payment_transactions_archive.bulk_write([
+                ReplaceOne({"transaction_id": txn["transaction_id"]}, txn, upsert=True)
+                for txn in transactions
+            ], ordered=False)
+        await db.bookings_archive.bulk_write([
+            ReplaceOne({"booking_id": booking["booking_id"]}, booking, upsert=True)
+            for booking in batch
+        ], ordered=False)
+        
+        if transactions:
+            await db.payment_transactions.delete_many({"_id": {"$in": [txn["_id"] for txn in transactions]}})
+        await db.bookings.delete_many({"_id": {"$in": [booking["_id"] for booking in batch]}})
+        
+        archived_bookings += len(batch)
+        archived_transactions += len(transactions)
+    
+    return {
+        "cutoff_date": cutoff,
+        "archived_bookings": archived_bookings,
+        "archived_transactions": archived_transactions
+    }
+
+async def archive_loop():
+    """Run the archival job periodically in the background"""
+    while True:
+        try:
+            result = await archive_old_bookings()
+            if result["archived_bookings"]:
+                logger.info(f"Archived {result['archived_bookings']} bookings before {result['cutoff_date']}")
+        except Exception:
+            logger.exception("Booking archival failed")
+        await asyncio.sleep(ARCHIVE_INTERVAL_HOURS * 60 * 60)
+
+def empty_heatmap() -> List[List[float]]:
+    """A weekday (Monday first) x hour grid covering every bookable slot"""
+    return [[0] * len(generate_time_slots()) for _ in range(7)]
+
+def parse_booking_date(date: str) -> Optional[datetime]:
+    """Parse a stored YYYY-MM-DD booking date; None for anything malformed"""
+    try:
+        parsed = datetime.strptime(date, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+    return parsed if parsed.strftime("%Y-%m-%d") == date else None
+
+async def refresh_occupancy_heatmap(until: Optional[str] = None) -> Dict[str, int]:
+    """Fold bookings for days not yet aggregated (up to yesterday by default) into the heatmap document"""
+    current = await db.analytics.find_one({"_id": ANALYTICS_DOC_ID})
+    processed_through = current["processed_through"] if current else None
+    last_day = until or (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+    if processed_through and processed_through >= last_day:
+        return {"processed_days": 0}
+    
+    # The archive is always included: days can be archived before they are aggregated
+    # if this job has been off or failing for longer than ARCHIVE_HORIZON_DAYS
+    date_match = {"$lte": last_day}
+    if processed_through:
+        date_match["$gt"] = processed_through
+    pipeline = [
+        {"$match": {"date": date_match}},
+        {"$unionWith": {"coll": "bookings_archive", "pipeline": [{"$match": {"date": date_match}}]}}
+    ]
+    pipeline.append({"$group": {
+        "_id": {"court_id": "$court_id", "date": "$date", "time_slot": "$time_slot"},
+        "booked": {"$sum": {"$cond": [{"$ne": ["$status", "cancelled"]}, 1, 0]}},
+        "cancelled": {"$sum": {"$cond": [{"$eq": ["$status", "cancelled"]}, 1, 0]}},
+        "revenue": {"$sum": {"$cond": [{"$eq": ["$payment_status", "paid"]}, "$price", 0]}}
+    }})
+    groups = await db.bookings.aggregate(pipeline).to_list(None)
+    
+    # Booking dates are not validated on write; a malformed one must not stall the job
+    parsed_groups = []
+    for group in groups:
+        date = parse_booking_date(group["_id"].get("date"))
+        if date is None:
+            logger.warning(f"Skipping bookings with malformed date in occupancy heatmap: {group['_id']}")
+            continue
+        parsed_groups.append((group, date))
+    
+    if processed_through:
+        first_day = datetime.strptime(processed_through, "%Y-%m-%d") + timedelta(days=1)
+    elif parsed_groups:
+        first_day = min(date for _, date in parsed_groups)
+    else:
+        first_day = datetime.strptime(last_day, "%Y-%m-%d")
+    
+    heatmap = current or {
+        "_id": ANALYTICS_DOC_ID,
+        "first_date": first_day.strftime("%Y-%m-%d"),
+        "hours": generate_time_slots(),
+        "weekday_days": [0] * 7,
+        "courts": {}
+    }
+    
+    processed_days = (datetime.strptime(last_day, "%Y-%m-%d") - first_day).days + 1
+    for offset in range(processed_days):
+        heatmap["weekday_days"][(first_day + timedelta(days=offset)).weekday()] += 1
+    
+    hours = heatmap["hours"]
+    for group, date in parsed_groups:
+        key = group["_id"]
+        if key["time_slot"] not in hours:
+            continue
+        court = heatmap["courts"].setdefault(key["court_id"], {
+            "booked": empty_heatmap(),
+            "revenue": empty_heatmap(),
+            "total_bookings": 0,
+            "cancelled_bookings": 0
+        })
+        weekday = date.weekday()
+        hour = hours.index(key["time_slot"])
+        court["booked"][weekday][hour] += group["booked"]
+        court["revenue"][weekday][hour] += group["revenue"]
+        court["total_bookings"] += group["booked"] + group["cancelled"]
+        court["cancelled_bookings"] += group["cancelled"]
+    
+    # Store the rates as well so the request path only reads this document
+    total_bookings = 0
+    cancelled_bookings = 0
+    for court in heatmap["courts"].values():
+        court["occupancy"] = [
+            [booked / days if days else 0 for booked in row]
+            for row, days in zip(court["booked"], heatmap["weekday_days"])
+        ]
+        court["cancellation_rate"] = court["cancelled_bookings"] / court["total_bookings"] if court["total_bookings"] else 0
+        total_bookings += court["total_bookings"]
+        cancelled_bookings += court["cancelled_bookings"]
+    heatmap["cancellation_rate"] = cancelled_bookings / total_bookings if total_bookings else 0
+    heatmap["processed_through"] = last_day
+    heatmap["updated_at"] = datetime.now(timezone.utc)
+    
+    # Only apply on top of the version we read, so concurrent workers never count a day twice
+    if current:
+        result = await db.analytics.replace_one(
+            {"_id": ANALYTICS_DOC_ID, "processed_through": processed_through},
+            heatmap
+        )
+        if not result.matched_count:
+            return {"processed_days": 0}
+    else:
+        try:
+            await db.analytics.insert_one(heatmap)
+        except DuplicateKeyError:
+            return {"processed_days": 0}
+    
+    return {"processed_days": processed_days}
+
+async def analytics_loop():
+    """Refresh the occupancy heatmap periodically in the background"""
+    while True:
+        try:
+            result = await refresh_occupancy_heatmap()
+            if result["processed_days"]:
+                logger.info(f"Occupancy heatmap updated with {result['processed_days']} days")
+        except Exception:
+            logger.exception("Occupancy heatmap refresh failed")
+        await asyncio.sleep(ANALYTICS_INTERVAL_HOURS * 60 * 60)
+
 # ==================== AUTH ROUTES ====================
 
 @api_router.post("/auth/register", response_model=SessionResponse)
 async def register(user_data: UserCreate, response: Response):
-    # Check if user exists
-    existing_user = await db.users.find_one({"email": user_data.email})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
-    # Create user
+    # Create user (the unique email index rejects existing users)
     user_id = f"user_{uuid.uuid4().hex[:12]}"
     hashed_pwd = hash_password(user_data.password)
     
@@ -237,7 +779,10 @@ async def register(user_data: UserCreate, response: Response):
         "created_at": datetime.now(timezone.utc)
     }
     
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create JWT token
     token = create_jwt_token(user_id, user_data.email)
@@ -307,33 +852,9 @@ async def google_callback(session_data: SessionCreate, response: Response):
         
         google_user = auth_response.json()
     
-    # Check if user exists
-    user_doc = await db.users.find_one({"email": google_user["email"]}, {"_id": 0})
-    
-    if user_doc:
-        # Update user info
-        await db.users.update_one(
-            {"user_id": user_doc["user_id"]},
-            {"$set": {
-                "name": google_user["name"],
-                "picture": google_user["picture"]
-            }}
-        )
-        user_id = user_doc["user_id"]
-    else:
-        # Create new user
-        user_id = f"user_{uuid.uuid4().hex[:12]}"
-        user_doc = {
-            "user_id": user_id,
-            "email": google_user["email"],
-            "phone": "",  # Can be updated later
-            "name": google_user["name"],
-            "picture": google_user["picture"],
-            "language": "ar",
-            "role": "user",
-            "created_at": datetime.now(timezone.utc)
-        }
-        await db.users.insert_one(user_doc)
+    # Create or update the user
+    user_doc = await upsert_google_user(google_user)
+    user_id = user_doc["user_id"]
     
     # Store session
     session_token = google_user["session_token"]
@@ -357,10 +878,6 @@ async def google_callback(session_data: SessionCreate, response: Response):
         max_age=7 * 24 * 60 * 60
     )
     
-    # Get updated user
-    user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-    user_doc.pop("password_hash", None)
-    
     return SessionResponse(
         session_token=session_token,
         user=User(**user_doc)
@@ -386,6 +903,102 @@ async def get_courts():
     courts = await db.courts.find({"is_active": True}, {"_id": 0}).to_list(100)
     return courts
 
+@api_router.get("/courts/search")
+async def search_free_courts(
+    date_from: str,
+    date_to: Optional[str] = None,
+    court_type: Optional[str] = None,
+    start_time: str = "08:00",
+    end_time: str = "24:00",
+    duration: int = 60,
+    preferred_time: Optional[str] = None,
+    limit: int = 20
+):
+    """Find free slots on any active court, ranked by closeness to the preferred time"""
+    date_to = date_to or date_from
+    try:
+        first_day = datetime.strptime(date_from, "%Y-%m-%d")
+        last_day = datetime.strptime(date_to, "%Y-%m-%d")
+        start_hour = int(start_time.split(":")[0])
+        end_hour = int(end_time.split(":")[0])
+        preferred_hour = int(preferred_time.split(":")[0]) if preferred_time else start_hour
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date or time format")
+    
+    if last_day < first_day or (last_day - first_day).days >= SEARCH_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range must span 1 to {SEARCH_MAX_DAYS} days")
+    if not (0 <= start_hour < end_hour <= 24) or not 0 <= preferred_hour <= 23:
+        raise HTTPException(status_code=400, detail="Hours must be between 00:00 and 24:00, with start_time before end_time")
+    if duration < 60 or duration % 60 != 0:
+        raise HTTPException(status_code=400, detail="Duration must be a multiple of 60 minutes")
+    
+    slots_needed = duration // 60
+    limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+    # Slots that have already started (in the courts' local time) are never offered
+    now = datetime.now(COURT_TIMEZONE)
+    today = now.strftime("%Y-%m-%d")
+    dates = [
+        (first_day + timedelta(days=offset)).strftime("%Y-%m-%d")
+        for offset in range((last_day - first_day).days + 1)
+    ]
+    dates = [date for date in dates if date >= today]
+    if not dates:
+        return {"results": [], "total_available": 0}
+    
+    court_match = {"is_active": True}
+    if court_type:
+        court_match["type"] = court_type
+    
+    # One round trip: active courts joined with their taken slots in the range
+    courts = await db.courts.aggregate([
+        {"$match": court_match},
+        {"$lookup": {
+            "from": "bookings",
+            "let": {"court_id": "$court_id"},
+            "pipeline": [
+                {"$match": {
+                    "$expr": {"$eq": ["$court_id", "$$court_id"]},
+                    "date": {"$gte": dates[0], "$lte": dates[-1]},
+                    "status": {"$ne": "cancelled"}
+                }},
+                {"$project": {"_id": 0, "date": 1, "time_slot": 1}}
+            ],
+            "as": "taken"
+        }},
+        {"$project": {"_id": 0, "court_id": 1, "name_ar": 1, "name_en": 1, "type": 1, "taken": 1}}
+    ]).to_list(None)
+    
+    all_slots = generate_time_slots()
+    options = []
+    for court in courts:
+        taken = {(booking["date"], booking["time_slot"]) for booking in court.pop("taken")}
+        for date in dates:
+            for index in range(len(all_slots) - slots_needed + 1):
+                window = all_slots[index:index + slots_needed]
+                hour = int(window[0].split(":")[0])
+                if hour < start_hour or hour + slots_needed > end_hour:
+                    continue
+                if date == today and hour <= now.hour:
+                    continue
+                if any((date, time_slot) in taken for time_slot in window):
+                    continue
+                price = sum(calculate_price(time_slot) for time_slot in window)
+                options.append({
+                    **court,
+                    "date": date,
+                    "time_slot": window[0],
+                    "duration": duration,
+                    "price": price,
+                    "_rank": (abs(hour - preferred_hour), date, price)
+                })
+    
+    options.sort(key=lambda option: option["_rank"])
+    results = options[:limit]
+    for option in results:
+        option.pop("_rank")
+    
+    return {"results": results, "total_available": len(options)}
+
 @api_router.get("/courts/{court_id}", response_model=Court)
 async def get_court(court_id: str):
     court = await db.courts.find_one({"court_id": court_id}, {"_id": 0})
@@ -415,28 +1028,31 @@ async def create_court(court_data: CourtCreate, request: Request):
 @api_router.get("/bookings/availability")
 async def check_availability(court_id: str, date: str):
     """Get all available time slots for a court on a specific date"""
-    # Generate all possible time slots (8 AM to 11 PM, 60-min slots)
+    court = await db.courts.find_one({"court_id": court_id}, {"_id": 0, "is_active": 1})
+    if not court:
+        raise HTTPException(status_code=404, detail="Court not found")
+    
+    # Generate all possible time slots (8 AM to 11 PM, 60-min slots); none are bookable on an inactive court
+    is_active = court.get("is_active", True)
+    taken_slots = await find_taken_slots(court_id, date) if is_active else set()
     all_slots = []
-    for hour in range(8, 24):  # 8 AM to 11 PM (last slot starts at 11 PM)
-        time_slot = f"{hour:02d}:00"
+    for time_slot in generate_time_slots():
         price = calculate_price(time_slot)
-        is_available = await check_slot_availability(court_id, date, time_slot)
         all_slots.append({
             "time_slot": time_slot,
             "price": price,
-            "is_available": is_available
+            "is_available": is_active and time_slot not in taken_slots
         })
     
     return {"date": date, "slots": all_slots}
 
-@api_router.post("/bookings", response_model=Booking)
-async def create_booking(booking_data: BookingCreate, request: Request):
-    user = await get_current_user(request)
-    
+async def insert_booking(booking_data: BookingCreate, user: User) -> dict:
     # Validate court exists
     court = await db.courts.find_one({"court_id": booking_data.court_id})
     if not court:
         raise HTTPException(status_code=404, detail="Court not found")
+    if not court.get("is_active", True):
+        raise HTTPException(status_code=400, detail="Court is not available")
     
     # Check availability
     is_available = await check_slot_availability(
@@ -468,21 +1084,30 @@ async def create_booking(booking_data: BookingCreate, request: Request):
     
     await db.bookings.insert_one(booking_doc)
     booking_doc.pop("_id")
-    return Booking(**booking_doc)
+    return booking_doc
+
+@api_router.post("/bookings", response_model=Booking)
+async def create_booking(
+    booking_data: BookingCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    user = await get_current_user(request)
+    return await run_idempotent(
+        idempotency_key, "bookings", user.user_id, booking_data,
+        lambda: insert_booking(booking_data, user)
+    )
 
 @api_router.get("/bookings/my", response_model=List[Booking])
 async def get_my_bookings(request: Request):
     user = await get_current_user(request)
-    bookings = await db.bookings.find(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
+    bookings = await find_bookings_with_archive({"user_id": user.user_id}, 100)
     return bookings
 
 @api_router.get("/bookings/{booking_id}", response_model=Booking)
 async def get_booking(booking_id: str, request: Request):
     user = await get_current_user(request)
-    booking = await db.bookings.find_one({"booking_id": booking_id}, {"_id": 0})
+    booking = await find_booking({"booking_id": booking_id}, {"_id": 0})
     
     if not booking:
         raise HTTPException(status_code=404, detail="Booking not found")
@@ -515,10 +1140,7 @@ async def cancel_booking(booking_id: str, request: Request):
 
 # ==================== PAYMENT ROUTES ====================
 
-@api_router.post("/payments/checkout")
-async def create_checkout(checkout_data: CheckoutRequest, request: Request):
-    user = await get_current_user(request)
-    
+async def start_checkout(checkout_data: CheckoutRequest, user: User) -> dict:
     # Get booking
     booking = await db.bookings.find_one({"booking_id": checkout_data.booking_id})
     if not booking:
@@ -570,6 +1192,18 @@ async def create_checkout(checkout_data: CheckoutRequest, request: Request):
     
     return {"url": session.url, "session_id": session.session_id}
 
+@api_router.post("/payments/checkout")
+async def create_checkout(
+    checkout_data: CheckoutRequest,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    user = await get_current_user(request)
+    return await run_idempotent(
+        idempotency_key, "checkout", user.user_id, checkout_data,
+        lambda: start_checkout(checkout_data, user)
+    )
+
 @api_router.get("/payments/status/{session_id}")
 async def get_payment_status(session_id: str, request: Request):
     user = await get_current_user(request)
@@ -589,23 +1223,9 @@ async def get_payment_status(session_id: str, request: Request):
     try:
         checkout_status = await stripe_checkout.get_checkout_status(session_id)
         
-        # Update transaction and booking if paid
-        if checkout_status.payment_status == "paid" and transaction["payment_status"] != "paid":
-            await db.payment_transactions.update_one(
-                {"session_id": session_id},
-                {"$set": {
-                    "payment_status": "paid",
-                    "updated_at": datetime.now(timezone.utc)
-                }}
-            )
-            
-            await db.bookings.update_one(
-                {"booking_id": transaction["booking_id"]},
-                {"$set": {
-                    "payment_status": "paid",
-                    "status": "confirmed"
-                }}
-            )
+        # Update transaction and booking if paid (idempotent, so it also repairs a half-applied update)
+        if checkout_status.payment_status == "paid":
+            await mark_transaction_paid(session_id)
         
         return {
             "status": checkout_status.status,
@@ -629,23 +1249,7 @@ async def stripe_webhook(request: Request):
         
         # Update transaction and booking
         if webhook_response.payment_status == "paid":
-            booking_id = webhook_response.metadata.get("booking_id")
-            
-            await db.payment_transactions.update_one(
-                {"session_id": webhook_response.session_id},
-                {"$set": {
-                    "payment_status": "paid",
-                    "updated_at": datetime.now(timezone.utc)
-                }}
-            )
-            
-            await db.bookings.update_one(
-                {"booking_id": booking_id},
-                {"$set": {
-                    "payment_status": "paid",
-                    "status": "confirmed"
-                }}
-            )
+            await mark_transaction_paid(webhook_response.session_id)
         
         return {"status": "success"}
     except Exception as e:
@@ -661,8 +1265,8 @@ async def create_review(review_data: ReviewCreate, request: Request):
     if review_data.rating < 1 or review_data.rating > 5:
         raise HTTPException(status_code=400, detail="Rating must be between 1 and 5")
     
-    # Check if user has completed booking for this court
-    booking = await db.bookings.find_one({
+    # Check if user has completed booking for this court (including archived history)
+    booking = await find_booking({
         "user_id": user.user_id,
         "court_id": review_data.court_id,
         "status": "confirmed",
@@ -698,7 +1302,7 @@ async def get_court_reviews(court_id: str):
 # ==================== ADMIN ROUTES ====================
 
 @api_router.get("/admin/bookings", response_model=List[Booking])
-async def get_all_bookings(request: Request, status: Optional[str] = None):
+async def get_all_bookings(request: Request, status: Optional[str] = None, include_archived: bool = True):
     user = await get_current_user(request)
     if user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
@@ -707,6 +1311,9 @@ async def get_all_bookings(request: Request, status: Optional[str] = None):
     if status:
         query["status"] = status
     
+    if include_archived:
+        return await find_bookings_with_archive(query, 1000)
+    
     bookings = await db.bookings.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
     return bookings
 
@@ -725,10 +1332,11 @@ async def get_admin_stats(request: Request):
     if user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    total_bookings = await db.bookings.count_documents({})
+    total_bookings = await db.bookings.count_documents({}) + await db.bookings_archive.count_documents({})
     total_users = await db.users.count_documents({})
     total_revenue = await db.bookings.aggregate([
         {"$match": {"payment_status": "paid"}},
+        {"$unionWith": {"coll": "bookings_archive", "pipeline": [{"$match": {"payment_status": "paid"}}]}},
         {"$group": {"_id": None, "total": {"$sum": "$price"}}}
     ]).to_list(1)
     
@@ -740,6 +1348,167 @@ async def get_admin_stats(request: Request):
         "total_revenue": revenue
     }
 
+@api_router.get("/admin/analytics")
+async def get_admin_analytics(request: Request):
+    """Occupancy and revenue heatmaps by court x weekday (Monday first) x hour"""
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    heatmap = await db.analytics.find_one({"_id": ANALYTICS_DOC_ID}, {"_id": 0})
+    if not heatmap:
+        raise HTTPException(status_code=404, detail="Analytics not computed yet")
+    return heatmap
+
+@api_router.post("/admin/analytics/refresh")
+async def refresh_admin_analytics(request: Request):
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return await refresh_occupancy_heatmap()
+
+@api_router.post("/admin/courts/bulk", response_model=List[Court])
+async def bulk_create_courts(courts_data: List[CourtCreate], request: Request):
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    if not courts_data:
+        return []
+    
+    court_docs = [
+        {
+            "court_id": f"court_{uuid.uuid4().hex[:12]}",
+            **court_data.model_dump(),
+            "is_active": True
+        }
+        for court_data in courts_data
+    ]
+    
+    await db.courts.insert_many(court_docs)
+    for court_doc in court_docs:
+        court_doc.pop("_id")
+    return [Court(**court_doc) for court_doc in court_docs]
+
+@api_router.patch("/admin/courts/status")
+async def bulk_update_court_status(status_data: CourtStatusUpdate, request: Request):
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    # Only courts that exist and are not already in the target state are affected
+    changing = {"court_id": {"$in": status_data.court_ids}, "is_active": {"$ne": status_data.is_active}}
+    courts = await db.courts.find(changing, {"_id": 0, "court_id": 1}).to_list(None)
+    court_ids = [court["court_id"] for court in courts]
+    
+    if court_ids:
+        await db.courts.update_many(
+            {**changing, "court_id": {"$in": court_ids}},
+            {"$set": {"is_active": status_data.is_active}}
+        )
+    
+    return {"court_ids": court_ids, "is_active": status_data.is_active}
+
+@api_router.post("/admin/bookings/cancel")
+async def bulk_cancel_bookings(cancel_data: BulkCancelRequest, request: Request):
+    """Cancel every active booking for a court within a date range (e.g. for maintenance)"""
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    try:
+        first_day = datetime.strptime(cancel_data.date_from, "%Y-%m-%d")
+        last_day = datetime.strptime(cancel_data.date_to, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+    
+    if first_day > last_day:
+        raise HTTPException(status_code=400, detail="date_from must not be after date_to")
+    
+    # Stored dates are compared as strings, so query with the canonical YYYY-MM-DD form
+    date_range = {
+        "court_id": cancel_data.court_id,
+        "date": {"$gte": first_day.strftime("%Y-%m-%d"), "$lte": last_day.strftime("%Y-%m-%d")}
+    }
+    
+    # Tag the bookings this call actually cancels, so ones cancelled concurrently by someone else are not reported
+    cancellation_id = f"cancellation_{uuid.uuid4().hex[:12]}"
+    result = await db.bookings.update_many(
+        {**date_range, "status": {"$ne": "cancelled"}},
+        {"$set": {"status": "cancelled", "cancellation_id": cancellation_id}}
+    )
+    
+    booking_ids = []
+    if result.modified_count:
+        bookings = await db.bookings.find(
+            {**date_range, "cancellation_id": cancellation_id},
+            {"_id": 0, "booking_id": 1}
+        ).to_list(None)
+        booking_ids = [booking["booking_id"] for booking in bookings]
+    
+    return {"cancelled_booking_ids": booking_ids, "cancelled_count": len(booking_ids)}
+
+@api_router.post("/admin/archive")
+async def run_archive(request: Request, horizon_days: Optional[int] = None):
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    if horizon_days is not None and horizon_days < 1:
+        raise HTTPException(status_code=400, detail="Horizon must be at least 1 day")
+    
+    return await archive_old_bookings(horizon_days or ARCHIVE_HORIZON_DAYS)
+
+@api_router.get("/admin/profiling", response_model=ProfilingConfig)
+async def get_profiling_config(request: Request):
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return profiling_config
+
+@api_router.put("/admin/profiling", response_model=ProfilingConfig)
+async def set_profiling_config(config: ProfilingConfig, request: Request):
+    """Set the sampling rate for request profiling (applies to this worker process)"""
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    if not 0 <= config.sample_rate <= 1:
+        raise HTTPException(status_code=400, detail="Sample rate must be between 0 and 1")
+    
+    global profiling_config
+    profiling_config = config
+    return profiling_config
+
+@api_router.get("/admin/profiles")
+async def get_profiles(request: Request, path: Optional[str] = None):
+    """List stored profiles, optionally for one route path such as /api/bookings/{booking_id}"""
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    query = {"path": path} if path else {}
+    profiles = await db.request_profiles.find(
+        query,
+        {"_id": 0, "speedscope": 0}
+    ).sort("created_at", -1).to_list(100)
+    return profiles
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    """Return a stored profile in speedscope format (https://www.speedscope.app)"""
+    user = await get_current_user(request)
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    profile = await db.request_profiles.find_one({"profile_id": profile_id}, {"_id": 0, "speedscope": 1})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    return Response(content=profile["speedscope"], media_type="application/json")
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -751,6 +1520,130 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class MongoOpBudgetMiddleware:
+    """Count the Mongo operations of each request and log routes that exceed MONGO_OP_BUDGETS"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        ops = []
+        
+        async def send_with_op_count(message):
+            # The endpoint has finished by the time its response starts
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Mongo-Ops", str(len(ops)))
+            await send(message)
+        
+        token = request_mongo_ops.set(ops)
+        try:
+            await self.app(scope, receive, send_with_op_count if MONGO_OP_BUDGET_DEBUG else send)
+        finally:
+            request_mongo_ops.reset(token)
+        
+        route = scope.get("route")
+        budget = MONGO_OP_BUDGETS.get((scope["method"], route.path)) if route else None
+        if budget is not None and len(ops) > budget:
+            logger.warning(f"{scope['method']} {route.path} used {len(ops)} Mongo operations (budget {budget}): {ops}")
+
+app.add_middleware(MongoOpBudgetMiddleware)
+
+# Sampling configuration and the single profiler slot of this worker
+profiling_config = ProfilingConfig()
+profiler_busy = False
+
+def resolve_route_path(scope) -> str:
+    """The route template a request will be dispatched to, e.g. /api/bookings/{booking_id}"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return scope["path"]
+
+async def should_profile(scope) -> bool:
+    """Decide whether to profile a request that asked for it or may be sampled"""
+    request = Request(scope)
+    requested = request.headers.get(PROFILE_HEADER)
+    # The secret is checked first, so anyone can send the header without costing an auth lookup
+    if requested and PROFILE_SECRET and hmac.compare_digest(requested.encode(), PROFILE_SECRET.encode()):
+        try:
+            user = await get_current_user(request)
+        except HTTPException:
+            return False
+        return user.role == "admin"
+    
+    if profiling_config.sample_rate <= 0:
+        return False
+    if profiling_config.path and resolve_route_path(scope) != profiling_config.path:
+        return False
+    return random.random() < profiling_config.sample_rate
+
+class RequestProfilerMiddleware:
+    """Profile admin-requested or sampled requests; passes straight through otherwise"""
+    
+    header_name = PROFILE_HEADER.lower().encode()
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        global profiler_busy
+        if scope["type"] != "http" or (
+            profiling_config.sample_rate <= 0
+            and not any(name == self.header_name for name, _ in scope["headers"])
+        ):
+            await self.app(scope, receive, send)
+            return
+        
+        # Checked and claimed with no await in between, so only one request holds the profiler
+        if not await should_profile(scope) or profiler_busy:
+            await self.app(scope, receive, send)
+            return
+        profiler_busy = True
+        
+        profile_id = f"profile_{uuid.uuid4().hex[:12]}"
+        status_code = 500
+        
+        async def send_with_profile_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append("X-Profile-Id", profile_id)
+            await send(message)
+        
+        timings = []
+        timings_token = request_mongo_timings.set(timings)
+        # async_mode attributes time spent awaiting (e.g. Motor calls) to the awaiting frame
+        profiler = Profiler(interval=PROFILE_INTERVAL_SECONDS, async_mode="enabled")
+        try:
+            profiler.start()
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            if profiler.is_running:
+                profiler.stop()
+            request_mongo_timings.reset(timings_token)
+            profiler_busy = False
+        
+        await db.request_profiles.insert_one({
+            "profile_id": profile_id,
+            "method": scope["method"],
+            "path": resolve_route_path(scope),
+            "status_code": status_code,
+            "duration_ms": profiler.last_session.duration * 1000,
+            "mongo_commands": timings,
+            "mongo_time_ms": sum(timing["duration_ms"] for timing in timings),
+            "speedscope": profiler.output(renderer=SpeedscopeRenderer()),
+            "created_at": datetime.now(timezone.utc)
+        })
+
+# Added after MongoOpBudgetMiddleware so it runs outside it: the admin check
+# and profile storage are not charged to the profiled route's budget
+app.add_middleware(RequestProfilerMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -758,22 +1651,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+archive_task: Optional[asyncio.Task] = None
+analytics_task: Optional[asyncio.Task] = None
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if archive_task:
+        archive_task.cancel()
+    if analytics_task:
+        analytics_task.cancel()
     client.close()
 
 @app.on_event("startup")
 async def startup_db():
+    global archive_task, analytics_task
+    
     # Create indexes
     await db.users.create_index("email", unique=True)
     await db.users.create_index("user_id", unique=True)
     await db.courts.create_index("court_id", unique=True)
+    await db.courts.create_index([("is_active", 1), ("type", 1)])
     await db.bookings.create_index("booking_id", unique=True)
     await db.bookings.create_index([("court_id", 1), ("date", 1), ("time_slot", 1)])
+    await db.bookings.create_index("date")
+    await db.bookings_archive.create_index("booking_id", unique=True)
+    await db.bookings_archive.create_index([("user_id", 1), ("court_id", 1)])
+    await db.bookings_archive.create_index("created_at")
+    await db.bookings_archive.create_index("date")
     await db.reviews.create_index("review_id", unique=True)
     await db.user_sessions.create_index("session_token", unique=True)
     await db.payment_transactions.create_index("transaction_id", unique=True)
     await db.payment_transactions.create_index("session_id", unique=True)
+    await db.payment_transactions.create_index("booking_id")
+    await db.payment_transactions_archive.create_index("transaction_id", unique=True)
+    await db.idempotency_keys.create_index("key", unique=True)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_HOURS * 60 * 60)
+    await db.request_profiles.create_index("profile_id", unique=True)
+    await db.request_profiles.create_index("created_at", expireAfterSeconds=PROFILE_TTL_DAYS * 24 * 60 * 60)
     
     # Initialize courts if not exist
     court_count = await db.courts.count_documents({})
@@ -801,4 +1715,12 @@ async def startup_db():
             }
         ]
         await db.courts.insert_many(courts_data)
-        logger.info("Courts initialized")
\ No newline at end of file
+        logger.info("Courts initialized")
+    
+    # Start background archival of historical bookings
+    if ARCHIVE_INTERVAL_HOURS > 0:
+        archive_task = asyncio.create_task(archive_loop())
+    
+    # Start nightly aggregation of the occupancy heatmap
+    if ANALYTICS_INTERVAL_HOURS > 0:
+        analytics_task = asyncio.create_task(analytics_loop())
\ No newline at end of file
@@ -0,0 +1,106 @@
+import json
+import os
+import sys
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+# Configure the backend before it is imported: a throwaway database, no background jobs
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = f"test_courts_{uuid.uuid4().hex[:8]}"
+os.environ["ARCHIVE_INTERVAL_HOURS"] = "0"
+os.environ["ANALYTICS_INTERVAL_HOURS"] = "0"
+os.environ["MONGO_OP_BUDGET_DEBUG"] = "true"
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+
+def mongo_available() -> bool:
+    try:
+        MongoClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=1000).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def server():
+    if not mongo_available():
+        pytest.skip("MongoDB is not reachable at MONGO_URL")
+    import server
+    return server
+
+
+@pytest.fixture
+async def db(server):
+    await server.startup_db()
+    server.idempotency_cache.clear()
+    yield server.db
+    await server.client.drop_database(os.environ["DB_NAME"])
+
+
+@pytest.fixture
+async def api(server, db):
+    import httpx
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+async def create_user(server, role: str = "user") -> dict:
+    """Insert a user directly and return auth headers for it"""
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    email = f"{user_id}@example.com"
+    await server.db.users.insert_one({
+        "user_id": user_id,
+        "email": email,
+        "phone": "+971501234567",
+        "password_hash": server.hash_password("secret"),
+        "name": "Test User",
+        "language": "en",
+        "role": role,
+        "picture": None,
+        "created_at": server.datetime.now(server.timezone.utc)
+    })
+    token = server.create_jwt_token(user_id, email)
+    return {"user_id": user_id, "email": email, "headers": {"Authorization": f"Bearer {token}"}}
+
+
+@pytest.fixture
+async def user(server, db):
+    return await create_user(server)
+
+
+@pytest.fixture
+async def admin(server, db):
+    return await create_user(server, role="admin")
+
+
+class FakeStripeCheckout:
+    def __init__(self, api_key, webhook_url):
+        pass
+
+    async def create_checkout_session(self, checkout_request):
+        return SimpleNamespace(session_id=f"cs_{uuid.uuid4().hex[:12]}", url="https://stripe.test/pay")
+
+    async def get_checkout_status(self, session_id):
+        return SimpleNamespace(status="complete", payment_status="paid", amount_total=13500, currency="aed")
+
+    async def handle_webhook(self, body, signature):
+        payload = json.loads(body)
+        return SimpleNamespace(payment_status="paid", session_id=payload["session_id"], metadata={})
+
+
+@pytest.fixture
+def fake_stripe(server, monkeypatch):
+    monkeypatch.setattr(server, "StripeCheckout", FakeStripeCheckout)
+    return FakeStripeCheckout
@@ -0,0 +1,91 @@
+from datetime import datetime, timezone
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def seed_booking(server, booking_id: str, date: str, court_id: str = "court_padel_001", status: str = "pending"):
+    await server.db.bookings.insert_one({
+        "booking_id": booking_id,
+        "user_id": "user_bulk",
+        "court_id": court_id,
+        "date": date,
+        "time_slot": "19:00",
+        "duration": 60,
+        "price": 135.0,
+        "status": status,
+        "payment_status": "pending",
+        "created_at": datetime.now(timezone.utc)
+    })
+
+
+async def test_bulk_cancel_reports_exactly_what_it_cancelled(api, server, db, admin):
+    await seed_booking(server, "booking_jan", "2099-01-05")
+    await seed_booking(server, "booking_mar", "2099-03-10")
+    await seed_booking(server, "booking_nov", "2099-11-20")
+    await seed_booking(server, "booking_already", "2099-02-01", status="cancelled")
+    await seed_booking(server, "booking_next_year", "2100-01-01")
+    await seed_booking(server, "booking_other_court", "2099-03-10", court_id="court_football_001")
+
+    # Non-canonical input is normalised before the string comparison
+    response = await api.post("/api/admin/bookings/cancel", headers=admin["headers"], json={
+        "court_id": "court_padel_001", "date_from": "2099-1-05", "date_to": "2099-12-31"
+    })
+    assert response.status_code == 200
+    assert sorted(response.json()["cancelled_booking_ids"]) == ["booking_jan", "booking_mar", "booking_nov"]
+    assert response.json()["cancelled_count"] == 3
+
+    active = {b["booking_id"] async for b in db.bookings.find({"status": {"$ne": "cancelled"}})}
+    assert active == {"booking_next_year", "booking_other_court"}
+
+    # Nothing left to cancel
+    again = await api.post("/api/admin/bookings/cancel", headers=admin["headers"], json={
+        "court_id": "court_padel_001", "date_from": "2099-01-01", "date_to": "2099-12-31"
+    })
+    assert again.json() == {"cancelled_booking_ids": [], "cancelled_count": 0}
+
+
+@pytest.mark.parametrize("dates", [
+    {"date_from": "2099/01/01", "date_to": "2099-12-31"},
+    {"date_from": "2099-13-01", "date_to": "2099-12-31"},
+    {"date_from": "2099-12-31", "date_to": "2099-01-01"},
+])
+async def test_bulk_cancel_rejects_bad_ranges(api, admin, dates):
+    response = await api.post("/api/admin/bookings/cancel", headers=admin["headers"], json={
+        "court_id": "court_padel_001", **dates
+    })
+    assert response.status_code == 400
+
+
+async def test_court_status_reports_only_changed_courts(api, admin, user):
+    response = await api.patch("/api/admin/courts/status", headers=admin["headers"], json={
+        "court_ids": ["court_padel_001", "court_football_001", "court_missing"], "is_active": False
+    })
+    assert sorted(response.json()["court_ids"]) == ["court_football_001", "court_padel_001"]
+
+    # Already inactive: nothing changes
+    response = await api.patch("/api/admin/courts/status", headers=admin["headers"], json={
+        "court_ids": ["court_padel_001"], "is_active": False
+    })
+    assert response.json()["court_ids"] == []
+
+    availability = await api.get("/api/bookings/availability?court_id=court_padel_001&date=2099-01-05")
+    assert not any(slot["is_available"] for slot in availability.json()["slots"])
+
+    booking = await api.post("/api/bookings", headers=user["headers"], json={
+        "court_id": "court_padel_001", "date": "2099-01-05", "time_slot": "19:00"
+    })
+    assert booking.status_code == 400
+
+    response = await api.patch("/api/admin/courts/status", headers=admin["headers"], json={
+        "court_ids": ["court_padel_001"], "is_active": True
+    })
+    assert response.json()["court_ids"] == ["court_padel_001"]
+    availability = await api.get("/api/bookings/availability?court_id=court_padel_001&date=2099-01-05")
+    assert all(slot["is_available"] for slot in availability.json()["slots"])
+
+
+async def test_availability_for_unknown_court(api):
+    response = await api.get("/api/bookings/availability?court_id=court_missing&date=2099-01-05")
+    assert response.status_code == 404
@@ -0,0 +1,58 @@
+from datetime import datetime, timezone
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def booking(date: str, time_slot: str, status: str = "confirmed", payment_status: str = "paid") -> dict:
+    return {
+        "booking_id": f"booking_{date}_{time_slot}_{status}",
+        "user_id": "user_analytics",
+        "court_id": "court_padel_001",
+        "date": date,
+        "time_slot": time_slot,
+        "duration": 60,
+        "price": 135.0 if time_slot >= "16:00" else 100.0,
+        "status": status,
+        "payment_status": payment_status,
+        "created_at": datetime.now(timezone.utc)
+    }
+
+
+async def test_incremental_fold(server, db):
+    # First run: Monday 2025-01-06 and Tuesday 2025-01-07
+    await db.bookings.insert_many([
+        booking("2025-01-06", "19:00"),
+        booking("2025-01-07", "10:00", status="cancelled", payment_status="pending"),
+    ])
+    assert await server.refresh_occupancy_heatmap(until="2025-01-07") == {"processed_days": 2}
+
+    heatmap = await db.analytics.find_one({"_id": server.ANALYTICS_DOC_ID})
+    assert heatmap["first_date"] == "2025-01-06"
+    assert heatmap["weekday_days"] == [1, 1, 0, 0, 0, 0, 0]
+
+    # Second run over the following days, one of them already archived and two with malformed dates
+    await db.bookings_archive.insert_one(booking("2025-01-13", "19:00", status="pending", payment_status="pending"))
+    await db.bookings.insert_many([
+        booking("2025-01-10T19", "19:00"),
+        booking("2025-01-1", "19:00"),
+    ])
+    assert await server.refresh_occupancy_heatmap(until="2025-01-13") == {"processed_days": 6}
+
+    heatmap = await db.analytics.find_one({"_id": server.ANALYTICS_DOC_ID})
+    assert heatmap["processed_through"] == "2025-01-13"
+    assert heatmap["weekday_days"] == [2, 1, 1, 1, 1, 1, 1]
+
+    court = heatmap["courts"]["court_padel_001"]
+    evening = heatmap["hours"].index("19:00")
+    morning = heatmap["hours"].index("10:00")
+    assert court["booked"][0][evening] == 2
+    assert court["occupancy"][0][evening] == 1.0
+    assert court["revenue"][0][evening] == 135.0
+    assert court["booked"][1][morning] == 0
+    assert court["total_bookings"] == 3
+    assert court["cancellation_rate"] == pytest.approx(1 / 3)
+
+    # Nothing new to fold
+    assert await server.refresh_occupancy_heatmap(until="2025-01-13") == {"processed_days": 0}
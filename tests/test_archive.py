@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def seed_booking(server, user_id: str, booking_id: str, days_ago: int):
+    now = datetime.now(timezone.utc)
+    await server.db.bookings.insert_one({
+        "booking_id": booking_id,
+        "user_id": user_id,
+        "court_id": "court_padel_001",
+        "date": (now - timedelta(days=days_ago)).strftime("%Y-%m-%d"),
+        "time_slot": "19:00",
+        "duration": 60,
+        "price": 135.0,
+        "status": "confirmed",
+        "payment_status": "paid",
+        "created_at": now - timedelta(days=days_ago + 1)
+    })
+    await server.db.payment_transactions.insert_one({
+        "transaction_id": f"txn_{booking_id}",
+        "booking_id": booking_id,
+        "user_id": user_id,
+        "session_id": f"cs_{booking_id}",
+        "amount": 135.0,
+        "currency": "aed",
+        "payment_status": "paid",
+        "created_at": now,
+        "updated_at": now
+    })
+
+
+async def test_archive_moves_only_old_bookings_with_transactions(server, db, user):
+    await seed_booking(server, user["user_id"], "booking_old_1", days_ago=200)
+    await seed_booking(server, user["user_id"], "booking_old_2", days_ago=100)
+    await seed_booking(server, user["user_id"], "booking_recent", days_ago=10)
+
+    result = await server.archive_old_bookings(horizon_days=90, batch_size=1)
+    assert result["archived_bookings"] == 2
+    assert result["archived_transactions"] == 2
+
+    assert [b["booking_id"] async for b in db.bookings.find()] == ["booking_recent"]
+    assert sorted([b["booking_id"] async for b in db.bookings_archive.find()]) == ["booking_old_1", "booking_old_2"]
+    assert [t["booking_id"] async for t in db.payment_transactions.find()] == ["booking_recent"]
+    assert sorted([t["booking_id"] async for t in db.payment_transactions_archive.find()]) == ["booking_old_1", "booking_old_2"]
+
+    # Running again is a no-op
+    assert (await server.archive_old_bookings(horizon_days=90))["archived_bookings"] == 0
+
+
+async def test_history_reads_fall_back_to_archive(api, server, db, user, admin):
+    await seed_booking(server, user["user_id"], "booking_old", days_ago=200)
+    await seed_booking(server, user["user_id"], "booking_recent", days_ago=10)
+    await server.archive_old_bookings(horizon_days=90)
+
+    response = await api.get("/api/bookings/booking_old", headers=user["headers"])
+    assert response.status_code == 200
+
+    my_bookings = await api.get("/api/bookings/my", headers=user["headers"])
+    assert [b["booking_id"] for b in my_bookings.json()] == ["booking_recent", "booking_old"]
+
+    all_bookings = await api.get("/api/admin/bookings", headers=admin["headers"])
+    assert {b["booking_id"] for b in all_bookings.json()} == {"booking_recent", "booking_old"}
+
+    # Only the archived booking makes the user eligible to review the court
+    await db.bookings.delete_many({})
+    review = await api.post("/api/reviews", headers=user["headers"], json={
+        "court_id": "court_padel_001", "rating": 5, "comment": "Still great"
+    })
+    assert review.status_code == 200
@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+BOOKING = {"court_id": "court_padel_001", "date": "2099-01-05", "time_slot": "19:00"}
+
+
+async def test_replay_returns_stored_response(api, server, user):
+    headers = {**user["headers"], "Idempotency-Key": "replay-1"}
+    first = await api.post("/api/bookings", json=BOOKING, headers=headers)
+    assert first.status_code == 200
+
+    replay = await api.post("/api/bookings", json=BOOKING, headers=headers)
+    assert replay.json() == first.json()
+
+    # Served from Mongo rather than the in-process cache, e.g. by another worker
+    server.idempotency_cache.clear()
+    replay = await api.post("/api/bookings", json=BOOKING, headers=headers)
+    assert replay.json() == first.json()
+
+    assert await server.db.bookings.count_documents({"user_id": user["user_id"]}) == 1
+
+
+async def test_key_reused_with_different_body_is_rejected(api, user):
+    headers = {**user["headers"], "Idempotency-Key": "reuse-1"}
+    assert (await api.post("/api/bookings", json=BOOKING, headers=headers)).status_code == 200
+
+    other = {**BOOKING, "time_slot": "20:00"}
+    response = await api.post("/api/bookings", json=other, headers=headers)
+    assert response.status_code == 422
+
+
+async def test_concurrent_duplicates_share_one_booking(api, server, user):
+    headers = {**user["headers"], "Idempotency-Key": "concurrent-1"}
+    responses = await asyncio.gather(*[
+        api.post("/api/bookings", json=BOOKING, headers=headers) for _ in range(3)
+    ])
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert len({response.json()["booking_id"] for response in responses}) == 1
+    assert await server.db.bookings.count_documents({"user_id": user["user_id"]}) == 1
+
+
+async def test_expired_lease_is_taken_over(api, server, user):
+    fingerprint = server.hashlib.sha256(server.BookingCreate(**BOOKING).model_dump_json().encode()).hexdigest()
+    await server.db.idempotency_keys.insert_one({
+        "key": f"bookings:{user['user_id']}:stale-1",
+        "fingerprint": fingerprint,
+        "status": "in_progress",
+        "locked_until": datetime.now(timezone.utc) - timedelta(seconds=1),
+        "created_at": datetime.now(timezone.utc)
+    })
+
+    headers = {**user["headers"], "Idempotency-Key": "stale-1"}
+    response = await api.post("/api/bookings", json=BOOKING, headers=headers)
+    assert response.status_code == 200
+
+
+async def test_cancelled_handler_releases_key(server, db):
+    payload = server.BookingCreate(**BOOKING)
+
+    async def interrupted():
+        raise asyncio.CancelledError()
+
+    with pytest.raises(asyncio.CancelledError):
+        await server.run_idempotent("cancelled-1", "bookings", "user_x", payload, interrupted)
+    await asyncio.sleep(0.2)
+    assert await db.idempotency_keys.count_documents({"key": "bookings:user_x:cancelled-1"}) == 0
+    assert not server.idempotency_release_tasks
+
+    async def completed():
+        return {"ok": True}
+
+    assert await server.run_idempotent("cancelled-1", "bookings", "user_x", payload, completed) == {"ok": True}
+
+
+async def test_lease_is_renewed_while_handler_runs(server, db, monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_LEASE_SECONDS", 0.3)
+    payload = server.BookingCreate(**BOOKING)
+    cache_key = "checkout:user_x:slow-1"
+    taken_over = []
+
+    async def slow_provider_call():
+        # Another worker retries well after the original lease would have expired
+        await asyncio.sleep(0.9)
+        taken_over.append(await server.claim_idempotency_key(cache_key, server.hashlib.sha256(
+            payload.model_dump_json().encode()).hexdigest()))
+        return {"session_id": "cs_1"}
+
+    assert await server.run_idempotent("slow-1", "checkout", "user_x", payload, slow_provider_call) == {"session_id": "cs_1"}
+    assert taken_over == [False]
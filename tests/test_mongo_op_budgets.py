@@ -0,0 +1,192 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi.routing import APIRoute
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeAuthClient:
+    def __init__(self, google_user):
+        self.google_user = google_user
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def get(self, url, headers=None):
+        return SimpleNamespace(status_code=200, json=lambda: self.google_user)
+
+
+def route_template(server, method: str, path: str) -> str:
+    """Resolve a concrete path to its route template the same way the router does"""
+    for route in server.app.routes:
+        if isinstance(route, APIRoute) and method in route.methods and route.path_regex.match(path):
+            return route.path
+    raise AssertionError(f"No route for {method} {path}")
+
+
+class BudgetChecker:
+    def __init__(self, server, api):
+        self.server = server
+        self.api = api
+        self.covered = set()
+
+    async def __call__(self, method: str, url: str, **kwargs):
+        response = await self.api.request(method, url, **kwargs)
+        assert response.status_code < 500, response.text
+
+        key = (method, route_template(self.server, method, url.split("?")[0]))
+        assert key in self.server.MONGO_OP_BUDGETS, f"{key} has no Mongo operation budget"
+        budget = self.server.MONGO_OP_BUDGETS[key]
+        ops = int(response.headers["X-Mongo-Ops"])
+        if budget is not None:
+            assert ops <= budget, f"{key} used {ops} Mongo operations, budget is {budget}"
+        self.covered.add(key)
+        return response
+
+
+async def test_every_route_stays_within_budget(api, server, user, admin, fake_stripe, monkeypatch):
+    check = BudgetChecker(server, api)
+    headers = user["headers"]
+    admin_headers = admin["headers"]
+    tomorrow = (datetime.now(server.COURT_TIMEZONE) + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    # Auth
+    credentials = {"email": "budget@example.com", "password": "secret"}
+    await check("POST", "/api/auth/register", json={**credentials, "phone": "+971500000000", "name": "Budget"})
+    await check("POST", "/api/auth/login", json=credentials)
+    monkeypatch.setattr(server, "httpx", SimpleNamespace(AsyncClient=lambda: FakeAuthClient({
+        "email": "google@example.com",
+        "name": "Google User",
+        "picture": "https://example.com/picture.png",
+        "session_token": f"session_{uuid.uuid4().hex}"
+    })))
+    google = await check("POST", "/api/auth/google/callback", json={"session_id": "session"})
+    session_token = google.json()["session_token"]
+    await check("GET", "/api/auth/me", headers=headers)
+    await check("GET", "/api/auth/me", headers={"Authorization": f"Bearer {session_token}"})
+    api.cookies.set("session_token", session_token)
+    await check("POST", "/api/auth/logout")
+    api.cookies.clear()
+
+    # Courts
+    await check("GET", "/api/courts")
+    await check("GET", f"/api/courts/search?date_from={tomorrow}&court_type=padel&preferred_time=19:00")
+    await check("GET", "/api/courts/court_padel_001")
+    await check("POST", "/api/courts", headers=admin_headers, json={
+        "name_ar": "ملعب", "name_en": "Court", "type": "padel", "description_ar": "-", "description_en": "-"
+    })
+
+    # Bookings
+    await check("GET", f"/api/bookings/availability?court_id=court_padel_001&date={tomorrow}")
+    booking = await check("POST", "/api/bookings", json={
+        "court_id": "court_padel_001", "date": tomorrow, "time_slot": "19:00"
+    }, headers={**headers, "Idempotency-Key": "budget-1"})
+    booking_id = booking.json()["booking_id"]
+    await check("GET", "/api/bookings/my", headers=headers)
+    await check("GET", f"/api/bookings/{booking_id}", headers=headers)
+
+    # Payments
+    checkout = await check("POST", "/api/payments/checkout", json={
+        "booking_id": booking_id, "origin_url": "https://courts.test"
+    }, headers={**headers, "Idempotency-Key": "budget-2"})
+    session_id = checkout.json()["session_id"]
+    await check("GET", f"/api/payments/status/{session_id}", headers=headers)
+    await check("POST", "/api/webhook/stripe", content=json.dumps({"session_id": session_id}))
+
+    # Reviews
+    await check("POST", "/api/reviews", json={"court_id": "court_padel_001", "rating": 5, "comment": "Great"}, headers=headers)
+    await check("GET", "/api/reviews/court_padel_001")
+
+    # Admin
+    await check("GET", "/api/admin/bookings", headers=admin_headers)
+    await check("GET", "/api/admin/users", headers=admin_headers)
+    await check("GET", "/api/admin/stats", headers=admin_headers)
+    await check("POST", "/api/admin/analytics/refresh", headers=admin_headers)
+    await check("GET", "/api/admin/analytics", headers=admin_headers)
+    await check("POST", "/api/admin/courts/bulk", headers=admin_headers, json=[
+        {"name_ar": "ملعب", "name_en": "Court 2", "type": "football", "description_ar": "-", "description_en": "-"}
+    ])
+    await check("PATCH", "/api/admin/courts/status", headers=admin_headers, json={
+        "court_ids": ["court_football_001"], "is_active": False
+    })
+    await check("POST", "/api/admin/bookings/cancel", headers=admin_headers, json={
+        "court_id": "court_padel_001", "date_from": tomorrow, "date_to": tomorrow
+    })
+    await check("PATCH", f"/api/bookings/{booking_id}/cancel", headers=headers)
+    await check("POST", "/api/admin/archive", headers=admin_headers)
+    await check("GET", "/api/admin/profiling", headers=admin_headers)
+    await check("PUT", "/api/admin/profiling", headers=admin_headers, json={"sample_rate": 0})
+    await check("GET", "/api/admin/profiles", headers=admin_headers)
+    await check("GET", "/api/admin/profiles/profile_missing", headers=admin_headers)
+
+    api_routes = {
+        (method, route.path)
+        for route in server.app.routes if isinstance(route, APIRoute)
+        for method in route.methods
+    }
+    assert api_routes == check.covered
+    assert set(server.MONGO_OP_BUDGETS) == api_routes
+
+
+async def test_cross_worker_duplicate_wait_counts_every_poll(api, server, user):
+    """A duplicate waiting on a request held by another worker pays for each poll, within its budget"""
+    body = {"court_id": "court_padel_001", "date": "2099-01-05", "time_slot": "19:00"}
+    fingerprint = server.hashlib.sha256(server.BookingCreate(**body).model_dump_json().encode()).hexdigest()
+    key = f"bookings:{user['user_id']}:worker-1"
+    await server.db.idempotency_keys.insert_one({
+        "key": key,
+        "fingerprint": fingerprint,
+        "status": "in_progress",
+        "locked_until": datetime.now(timezone.utc) + timedelta(seconds=30),
+        "created_at": datetime.now(timezone.utc)
+    })
+    stored = {"booking_id": "booking_other", "user_id": user["user_id"], **body, "duration": 60,
+              "price": 135.0, "status": "pending", "payment_status": "pending",
+              "created_at": "2099-01-01T00:00:00+00:00"}
+
+    async def finish_elsewhere():
+        await asyncio.sleep(0.5)
+        await server.db.idempotency_keys.update_one(
+            {"key": key}, {"$set": {"status": "completed", "response": stored}}
+        )
+
+    finisher = asyncio.create_task(finish_elsewhere())
+    response = await api.post("/api/bookings", json=body, headers={**user["headers"], "Idempotency-Key": "worker-1"})
+    await finisher
+
+    assert response.status_code == 200
+    assert response.json()["booking_id"] == "booking_other"
+    # Authentication, the failed reservation and the failed takeover, then polls at about 0.1s, 0.3s
+    # and 0.7s before the other worker's response is found
+    ops = int(response.headers["X-Mongo-Ops"])
+    assert 3 + 1 < ops <= 3 + 3
+    assert ops <= server.MONGO_OP_BUDGETS[("POST", "/api/bookings")]
+
+
+async def test_cross_worker_duplicate_wait_is_capped(api, server, user, monkeypatch):
+    """A duplicate gives up with 409 after IDEMPOTENCY_MAX_POLLS polls, however long the wait window"""
+    monkeypatch.setattr(server, "IDEMPOTENCY_POLL_INITIAL_SECONDS", 0.01)
+    monkeypatch.setattr(server, "IDEMPOTENCY_POLL_MAX_SECONDS", 0.01)
+    monkeypatch.setattr(server, "IDEMPOTENCY_MAX_POLLS", 5)
+    body = {"court_id": "court_padel_001", "date": "2099-01-05", "time_slot": "19:00"}
+    fingerprint = server.hashlib.sha256(server.BookingCreate(**body).model_dump_json().encode()).hexdigest()
+    await server.db.idempotency_keys.insert_one({
+        "key": f"bookings:{user['user_id']}:worker-1",
+        "fingerprint": fingerprint,
+        "status": "in_progress",
+        "locked_until": datetime.now(timezone.utc) + timedelta(seconds=30),
+        "created_at": datetime.now(timezone.utc)
+    })
+
+    response = await api.post("/api/bookings", json=body, headers={**user["headers"], "Idempotency-Key": "worker-1"})
+
+    assert response.status_code == 409
+    assert int(response.headers["X-Mongo-Ops"]) == 3 + 5
@@ -0,0 +1,79 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from pymongo.errors import PyMongoError
+
+pytestmark = pytest.mark.anyio
+
+
+class FailingBookings:
+    """Wraps db.bookings so that every update fails, as if the connection dropped mid-write"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def update_one(self, *args, **kwargs):
+        raise PyMongoError("connection dropped")
+
+
+class FailingBookingsDatabase:
+    def __init__(self, database):
+        self.database = database
+        self.bookings = FailingBookings(database.bookings)
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
+async def seed_pending_payment(server, user) -> str:
+    """Insert an unpaid booking with its pending transaction and return the session id"""
+    await server.db.bookings.insert_one({
+        "booking_id": "booking_pay", "user_id": user["user_id"], "court_id": "court_padel_001",
+        "date": "2099-01-05", "time_slot": "19:00", "duration": 60, "price": 135.0,
+        "status": "pending", "payment_status": "pending", "created_at": "2099-01-01T00:00:00+00:00"
+    })
+    await server.db.payment_transactions.insert_one({
+        "transaction_id": "txn_pay", "booking_id": "booking_pay", "user_id": user["user_id"],
+        "session_id": "cs_pay", "amount": 135.0, "currency": "aed", "payment_status": "pending",
+        "created_at": datetime.now(timezone.utc), "updated_at": datetime.now(timezone.utc)
+    })
+    return "cs_pay"
+
+
+async def test_webhook_retry_repairs_half_applied_payment(api, server, user, fake_stripe, monkeypatch):
+    session_id = await seed_pending_payment(server, user)
+    real_db = server.db
+
+    # The transaction is marked paid, then the booking update fails
+    monkeypatch.setattr(server, "db", FailingBookingsDatabase(real_db))
+    response = await api.post("/api/webhook/stripe", content=json.dumps({"session_id": session_id}))
+    assert response.status_code == 400
+    monkeypatch.setattr(server, "db", real_db)
+
+    transaction = await real_db.payment_transactions.find_one({"session_id": session_id})
+    booking = await real_db.bookings.find_one({"booking_id": "booking_pay"})
+    assert transaction["payment_status"] == "paid"
+    assert booking["payment_status"] == "pending"
+
+    # Stripe retries the webhook
+    response = await api.post("/api/webhook/stripe", content=json.dumps({"session_id": session_id}))
+    assert response.status_code == 200
+    booking = await real_db.bookings.find_one({"booking_id": "booking_pay"})
+    assert booking["payment_status"] == "paid"
+    assert booking["status"] == "confirmed"
+
+
+async def test_status_poll_repairs_half_applied_payment(api, server, user, fake_stripe):
+    session_id = await seed_pending_payment(server, user)
+    await server.db.payment_transactions.update_one({"session_id": session_id}, {"$set": {"payment_status": "paid"}})
+
+    response = await api.get(f"/api/payments/status/{session_id}", headers=user["headers"])
+    assert response.status_code == 200
+    assert response.json()["payment_status"] == "paid"
+    booking = await server.db.bookings.find_one({"booking_id": "booking_pay"})
+    assert booking["payment_status"] == "paid"
+    assert booking["status"] == "confirmed"
@@ -0,0 +1,65 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def reset_profiling(server, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_SECRET", "profile-secret")
+    yield
+    server.profiling_config = server.ProfilingConfig()
+
+
+@pytest.fixture
+def auth_lookups(server, monkeypatch):
+    """Count calls to get_current_user, wherever they come from"""
+    calls = []
+    get_current_user = server.get_current_user
+
+    async def counting_get_current_user(request):
+        calls.append(request.url.path)
+        return await get_current_user(request)
+
+    monkeypatch.setattr(server, "get_current_user", counting_get_current_user)
+    return calls
+
+
+async def test_admin_header_profiles_request(api, server, admin):
+    response = await api.get("/api/courts/court_padel_001", headers={**admin["headers"], "X-Profile-Request": "profile-secret"})
+    profile_id = response.headers["X-Profile-Id"]
+
+    profiles = await api.get("/api/admin/profiles?path=/api/courts/{court_id}", headers=admin["headers"])
+    assert [profile["profile_id"] for profile in profiles.json()] == [profile_id]
+
+    speedscope = await api.get(f"/api/admin/profiles/{profile_id}", headers=admin["headers"])
+    assert "shared" in speedscope.json()
+
+
+async def test_header_from_non_admin_is_ignored(api, user):
+    response = await api.get("/api/courts/court_padel_001", headers={**user["headers"], "X-Profile-Request": "profile-secret"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+
+
+@pytest.mark.parametrize("value", ["1", "wrong-secret"])
+async def test_header_without_secret_skips_auth_lookup(api, admin, auth_lookups, value):
+    response = await api.get("/api/courts/court_padel_001", headers={**admin["headers"], "X-Profile-Request": value})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    assert auth_lookups == []
+
+
+async def test_header_is_ignored_when_no_secret_is_configured(api, server, admin, auth_lookups, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_SECRET", None)
+    response = await api.get("/api/courts/court_padel_001", headers={**admin["headers"], "X-Profile-Request": "profile-secret"})
+    assert "X-Profile-Id" not in response.headers
+    assert auth_lookups == []
+
+
+async def test_sampling_matches_route_template(api, server, admin):
+    await api.put("/api/admin/profiling", headers=admin["headers"], json={
+        "sample_rate": 1, "path": "/api/courts/{court_id}"
+    })
+
+    assert "X-Profile-Id" in (await api.get("/api/courts/court_padel_001")).headers
+    assert "X-Profile-Id" not in (await api.get("/api/courts")).headers
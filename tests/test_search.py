@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def local_date(server, days: int = 0) -> str:
+    return (datetime.now(server.COURT_TIMEZONE) + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+async def book(server, court_id: str, date: str, time_slot: str, status: str = "confirmed"):
+    await server.db.bookings.insert_one({
+        "booking_id": f"booking_{court_id}_{date}_{time_slot}",
+        "user_id": "user_search",
+        "court_id": court_id,
+        "date": date,
+        "time_slot": time_slot,
+        "duration": 60,
+        "price": server.calculate_price(time_slot),
+        "status": status,
+        "payment_status": "paid",
+        "created_at": datetime.now(timezone.utc)
+    })
+
+
+async def search(api, **params):
+    response = await api.get("/api/courts/search", params=params)
+    assert response.status_code == 200, response.text
+    return response.json()["results"]
+
+
+async def test_results_ranked_by_preferred_time(api, server, db):
+    tomorrow = local_date(server, 1)
+    results = await search(api, date_from=tomorrow, court_type="padel", preferred_time="19:00", limit=5)
+
+    assert [r["time_slot"] for r in results] == ["19:00", "18:00", "20:00", "17:00", "21:00"]
+    assert all(r["court_id"] == "court_padel_001" and r["date"] == tomorrow for r in results)
+    assert results[0]["price"] == 135.0
+
+
+async def test_bookings_only_block_their_own_court(api, server, db):
+    tomorrow = local_date(server, 1)
+    await book(server, "court_padel_001", tomorrow, "19:00")
+    await book(server, "court_football_001", tomorrow, "20:00", status="cancelled")
+
+    results = await search(api, date_from=tomorrow, start_time="19:00", end_time="21:00", limit=50)
+    assert {(r["court_id"], r["time_slot"]) for r in results} == {
+        ("court_padel_001", "20:00"),
+        ("court_football_001", "19:00"),
+        ("court_football_001", "20:00"),
+    }
+
+
+async def test_time_window_and_inactive_courts(api, server, db):
+    tomorrow = local_date(server, 1)
+    await db.courts.update_one({"court_id": "court_football_001"}, {"$set": {"is_active": False}})
+
+    results = await search(api, date_from=tomorrow, start_time="10:00", end_time="12:00", limit=50)
+    assert {(r["court_id"], r["time_slot"]) for r in results} == {
+        ("court_padel_001", "10:00"),
+        ("court_padel_001", "11:00"),
+    }
+
+
+async def test_multi_slot_duration_needs_consecutive_free_slots(api, server, db):
+    tomorrow = local_date(server, 1)
+    await book(server, "court_padel_001", tomorrow, "20:00")
+
+    results = await search(api, date_from=tomorrow, court_type="padel", duration=120,
+                           start_time="15:00", end_time="23:00", limit=50)
+    by_start = {r["time_slot"]: r for r in results}
+    # 19:00 and 20:00 both overlap the booked 20:00 slot; a 2h slot must also end by 23:00
+    assert sorted(by_start) == ["15:00", "16:00", "17:00", "18:00", "21:00"]
+    assert by_start["15:00"]["price"] == 235.0
+    assert by_start["21:00"]["duration"] == 120
+
+
+async def test_past_dates_and_elapsed_hours_are_excluded(api, server, db):
+    yesterday, today = local_date(server, -1), local_date(server)
+    current_hour = datetime.now(server.COURT_TIMEZONE).hour
+
+    results = await search(api, date_from=yesterday, date_to=today, limit=50)
+    assert all(r["date"] == today for r in results)
+    assert all(int(r["time_slot"][:2]) > current_hour for r in results)
+
+    assert await search(api, date_from=local_date(server, -3), date_to=yesterday) == []
+
+
+@pytest.mark.parametrize("params", [
+    {"start_time": "25:00"},
+    {"end_time": "25:00"},
+    {"start_time": "-1:00"},
+    {"start_time": "20:00", "end_time": "18:00"},
+    {"preferred_time": "24:00"},
+    {"duration": 90},
+])
+async def test_invalid_parameters_are_rejected(api, server, db, params):
+    response = await api.get("/api/courts/search", params={"date_from": local_date(server, 1), **params})
+    assert response.status_code == 400